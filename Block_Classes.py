@@ -1,5 +1,6 @@
 from dataclasses import dataclass, asdict, field, fields
 from datetime import datetime
+from array import array
 import json
 
 @dataclass
@@ -36,6 +37,7 @@ class BTCPrice:
     close: float = 0.0
     volume: float = 0.0
     block_height: int = 0
+    vwap: float = 0.0
 
     @property
     def as_csv(self):
@@ -53,7 +55,8 @@ class BTCPrice:
                 'high':self.high,
                 'low':self.low,
                 'close':self.close,
-                'volume':self.volume}
+                'volume':self.volume,
+                'vwap':self.vwap}
 
         return asdict(self)
 
@@ -107,6 +110,28 @@ class BTCPrice:
     def from_dict(cls, data: dict):
         return cls(**data)
 
+    @classmethod
+    def merge(cls, prices: list):
+        """
+        combine a time ordered list of prices into a single price covering all of them
+        """
+        first, last = prices[0], prices[-1]
+        volume = sum(price.volume for price in prices)
+        lows = [price.low for price in prices if price.low > 0.0]
+        if volume > 0.0:
+            vwap = sum(price.vwap * price.volume for price in prices) / volume
+        else:
+            vwap = last.close
+        return cls(opentime=first.opentime,
+                   closetime=last.closetime,
+                   open=first.open,
+                   high=max(price.high for price in prices),
+                   low=min(lows) if lows else 0.0,
+                   close=last.close,
+                   volume=volume,
+                   block_height=first.block_height,
+                   vwap=vwap)
+
 
 # Dataclass to hold BTC Block Timestamp
 @dataclass
@@ -115,6 +140,7 @@ class BTCBlock(BTCPrice):
     first_tick: Tick = None
     last_tick: Tick = None
     seen: bool = False
+    turnover: float = 0.0  # running sum of price * volume, used for the vwap
     ticks: list = field(default_factory=list)
 
     def in_range(self, tick: Tick):
@@ -124,7 +150,7 @@ class BTCBlock(BTCPrice):
         else:
             return False
 
-    def consolidate(self):
+    def consolidate(self, exchange_prices: 'ExchangePrices' = None):
         # sort ticks by timestamp
         self.ticks.sort(key=lambda x: x.timestamp, reverse=False)
         if self.first_tick is None:
@@ -135,6 +161,7 @@ class BTCBlock(BTCPrice):
             latest = 0.0
         else:
             latest = self.last_tick.timestamp
+        exchanges = {}
         for tick in self.ticks:
             if tick.timestamp < earliest:
                 earliest = tick.timestamp
@@ -149,6 +176,23 @@ class BTCBlock(BTCPrice):
             if tick.price < float(self.low):
                 self.low = tick.price
             self.volume += tick.volume
+            self.turnover += tick.price * tick.volume
+            # per exchange ohlcv, ticks for an exchange arrive in time order so the
+            # first one seen is the open and the last one is the close
+            ohlcv = exchanges.get(tick.exchange)
+            if ohlcv is None:
+                exchanges[tick.exchange] = [tick.price, tick.price, tick.price, tick.price, tick.volume]
+            else:
+                ohlcv[1] = max(ohlcv[1], tick.price)
+                ohlcv[2] = min(ohlcv[2], tick.price)
+                ohlcv[3] = tick.price
+                ohlcv[4] += tick.volume
+        if self.volume > 0.0:
+            self.vwap = self.turnover / self.volume
+        # the per exchange prices go straight into the packed columns, the block keeps none of them
+        if exchange_prices is not None:
+            for exchange, ohlcv in exchanges.items():
+                exchange_prices.add(exchange, self.block_height, ohlcv)
         self.ticks = [] # wipe the list to conserve memory
 
     def get_BTCPrice(self):
@@ -159,7 +203,8 @@ class BTCBlock(BTCPrice):
                         low=self.low,
                         close=self.close,
                         volume=self.volume,
-                        block_height=self.block_height)
+                        block_height=self.block_height,
+                        vwap=self.vwap)
 
     @classmethod
     def from_json(cls, json_string):
@@ -196,4 +241,88 @@ class BTCBlock(BTCPrice):
         return blocks
 
 
+# Per exchange price columns, kept apart from BTCPrice so the block rows stay small
+class ExchangePrices:
+    ''' Class to hold per exchange open/high/low/close/volume columns indexed by block height'''
+    fields = ('open', 'high', 'low', 'close', 'volume')
+
+    def __init__(self, first_heights: dict = None, columns: dict = None):
+        # every exchange's columns only cover the blocks from the first one it traded in to the last,
+        # {exchange: first height} and {exchange: {field: array('d')}}. A volume of 0.0 in between
+        # means the exchange didn't trade in that block.
+        self.first_heights = first_heights if first_heights is not None else {}
+        self.columns = columns if columns is not None else {}
+
+    def add(self, exchange: str, height: int, ohlcv: list):
+        """
+        record an exchange's (open, high, low, close, volume) in a block, blocks arrive in height order
+        """
+        if exchange not in self.columns:
+            self.first_heights[exchange] = height
+            self.columns[exchange] = {name: array('d') for name in self.fields}
+        columns = self.columns[exchange]
+        index = height - self.first_heights[exchange]
+        if index < len(columns['volume']):
+            # a block whose ticks were split over two passes, merge into what is already there
+            if columns['volume'][index] > 0.0:
+                ohlcv = [columns['open'][index],
+                         max(columns['high'][index], ohlcv[1]),
+                         min(columns['low'][index], ohlcv[2]),
+                         ohlcv[3],
+                         columns['volume'][index] + ohlcv[4]]
+            for name, value in zip(self.fields, ohlcv):
+                columns[name][index] = value
+            return
+        padding = bytes(8 * (index - len(columns['volume'])))
+        for name, value in zip(self.fields, ohlcv):
+            columns[name].frombytes(padding)
+            columns[name].append(value)
 
+    def truncate(self, last_height: int):
+        """
+        drop every block after last_height
+        """
+        for exchange, columns in list(self.columns.items()):
+            length = last_height - self.first_heights[exchange] + 1
+            if length <= 0:
+                del self.columns[exchange], self.first_heights[exchange]
+                continue
+            for values in columns.values():
+                del values[length:]
+
+    def get(self, height: int) -> dict:
+        """
+        get the (open, high, low, close, volume) of every exchange that traded in a block
+        """
+        prices = {}
+        for exchange, columns in self.columns.items():
+            index = int(height) - self.first_heights[exchange]
+            if 0 <= index < len(columns['volume']) and columns['volume'][index] > 0.0:
+                prices[exchange] = tuple(columns[name][index] for name in self.fields)
+        return prices
+
+    def as_str(self, price: BTCPrice) -> str:
+        """
+        get a nicely formated per exchange comparison for sending to telegram
+        """
+        output = (f"Exchange prices for block {price.block_height}:\n"
+                  f"{'Exchange':<12}{'Close':>12}{'Volume':>16}\n")
+        for exchange, ohlcv in sorted(self.get(price.block_height).items()):
+            output += f"{exchange:<12}{ohlcv[3]:>12,.2f}{ohlcv[4]:>16,.8f}\n"
+        output += f"{'Composite':<12}{price.vwap:>12,.2f}{price.volume:>16,.8f}\n"
+        return output
+
+    @property
+    def as_dict(self):
+        """
+        get a python dictionary, the columns stay packed arrays so they pickle compactly
+        """
+        return {'first_heights': self.first_heights,
+                'columns': self.columns}
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        if 'first_height' in data:
+            # written when every exchange covered the whole height range
+            return cls({exchange: data['first_height'] for exchange in data['columns']}, data['columns'])
+        return cls(**data)
@@ -49,7 +49,11 @@ from telegram.ext import (
 )
 from telegram.constants import ParseMode
 from indexed_bzip2 import IndexedBzip2File
-from Block_Classes import Tick, BTCBlock, BTCPrice
+from Block_Classes import Tick, BTCBlock, BTCPrice, ExchangePrices
+from price_chart import PricePyramid, PriceChart, load_pyramid, save_pyramid
+from rollups import ROLLUP_SPANS, load_rollups, build_rollups, save_rollups
+from price_api import PriceAPI
+from price_validation import unpack_blockprices, data_version
 
 # Other Imports
 import json, asyncio, pickle
@@ -77,12 +81,22 @@ logging.getLogger("_client.py").setLevel(logging.WARNING)
 #logging.disable(logging.INFO)
 
 Bitcoin_blockprice = {}
+Bitcoin_exchangeprice = ExchangePrices()
+Bitcoin_chart = None
+Bitcoin_rollups = {}
 
 # =============== STARTUP FUNCTIONS
 async def post_init(application: Application) -> None:
     # Currently don't need any post_init
-    global Bitcoin_blockprice
-    Bitcoin_blockprice = await _load_blockprices()
+    global Bitcoin_blockprice, Bitcoin_exchangeprice, Bitcoin_chart, Bitcoin_rollups
+    Bitcoin_blockprice, blockprice_version = await _load_blockprices()
+    Bitcoin_exchangeprice = await _load_exchangeprices()
+    Bitcoin_rollups = await _load_rollups(blockprice_version)
+    Bitcoin_chart = PriceChart(await _load_pyramid(blockprice_version))
+    # Serve the same in-memory data over HTTP for internal services
+    if config.get('api', {}).get('enabled', False):
+        api = PriceAPI(Bitcoin_blockprice, Bitcoin_rollups, blockprice_version)
+        application.bot_data["api_server"] = await api.start(config['api']['host'], config['api']['port'])
     # Rebuild Hamburger Menu
     await application.bot.setMyCommands(command_list())
     return None
@@ -234,6 +248,49 @@ async def txprice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         await update.effective_message.reply_text("Usage: /sats <Block #>")
 
 
+async def compare(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Compare the exchange prices for a specific block."""
+    try:
+        block = context.args[0]
+        logger.debug(f"Get exchange prices for block {block}.")
+        response = _get_exchanges(int(block))
+        await update.effective_message.reply_text(f"{response}", parse_mode="Markdown")
+
+    except (IndexError, ValueError, KeyError) as e:
+        logger.debug(f"ERROR: {e}")
+        context.user_data["last_command"] = _get_exchanges
+        await update.effective_message.reply_text("Usage: /compare <Block #>")
+
+
+async def chart(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Return a price chart between two blocks."""
+    try:
+        start = int(context.args[0])
+        end = int(context.args[1]) if len(context.args) > 1 else Bitcoin_chart.pyramid.last_height
+        logger.debug(f"Get chart for blocks {start} to {end}.")
+        # rendering a new chart is cpu bound, keep it off the event loop
+        png = await asyncio.to_thread(Bitcoin_chart.render, start, end)
+        await update.effective_message.reply_photo(photo=png)
+
+    except (IndexError, ValueError) as e:
+        logger.debug(f"ERROR: {e}")
+        await update.effective_message.reply_text("Usage: /chart <From Block #> <To Block #>")
+
+
+async def epoch(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Return the price details for the day, difficulty or halving epoch containing a block."""
+    try:
+        period = str(context.args[0]).lower()
+        block = int(context.args[1])
+        logger.debug(f"Get {period} rollup for block {block}.")
+        response = _get_rollup(period, block)
+        await update.effective_message.reply_text(f"{response}", parse_mode="Markdown")
+
+    except (IndexError, ValueError, KeyError) as e:
+        logger.debug(f"ERROR: {e}")
+        await update.effective_message.reply_text(f"Usage: /epoch <{'|'.join(ROLLUP_SPANS.keys())}> <Block #>")
+
+
 # =============== ADVANCED BOT FUNCTIONS
 async def continue_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     # If the last command was entered without a parameter, allow the next message to
@@ -247,16 +304,46 @@ async def continue_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         context.user_data["last_command"] = None
 
 
-async def _load_blockprices() -> dict:
+async def _load_blockprices() -> (dict, str):
     temp_btc_blockprice = pickle.load(IndexedBzip2File("btc_blockprice.pkl.bz2", parallelization=0))
     #with IndexedBzip2File("bp.bz2", parallelization=0) as f:
     #    json_bytes = f.read()
     #json_str = json_bytes.decode('utf-8')
     #temp_btc_blockprice = json.loads(json_str)
-    btc_blockprice = {}
-    for block, price in temp_btc_blockprice.items():
-        btc_blockprice[int(block)] = BTCPrice.from_dict(price)
-    return btc_blockprice
+    # refuses a data file that doesn't match the checksums calc_blocks stamped it with, rebuilding
+    # the rows takes a few seconds so keep it off the event loop
+    btc_blockprice = await asyncio.to_thread(unpack_blockprices, temp_btc_blockprice)
+    version = data_version(temp_btc_blockprice['checksums']) if 'checksums' in temp_btc_blockprice else None
+    return btc_blockprice, version
+
+
+async def _load_rollups(blockprice_version: str) -> dict:
+    btc_rollups, version = load_rollups()
+    if version is None or version != blockprice_version:
+        # the rollups were built from other block price data, rebuild them so they agree with /block
+        logger.warning("Rollups don't match the block price data, rebuilding them.")
+        btc_rollups = await asyncio.to_thread(build_rollups, Bitcoin_blockprice)
+        await asyncio.to_thread(save_rollups, btc_rollups, blockprice_version)
+    return btc_rollups
+
+
+async def _load_pyramid(blockprice_version: str) -> PricePyramid:
+    # loading and building the pyramid both take a few seconds, keep them off the event loop
+    pyramid = await asyncio.to_thread(load_pyramid, Bitcoin_blockprice, blockprice_version)
+    if pyramid is None:
+        logger.warning("Price pyramid doesn't match the block price data, rebuilding it.")
+        pyramid = await asyncio.to_thread(PricePyramid, Bitcoin_blockprice)
+        await asyncio.to_thread(save_pyramid, pyramid, blockprice_version)
+    return pyramid
+
+
+async def _load_exchangeprices() -> ExchangePrices:
+    try:
+        temp_exchangeprice = pickle.load(IndexedBzip2File("btc_exchangeprice.pkl.bz2", parallelization=0))
+    except FileNotFoundError:
+        logger.warning("No per exchange price data found, /compare will be empty.")
+        return ExchangePrices()
+    return ExchangePrices.from_dict(temp_exchangeprice)
 
 
 def _check_end(block: int = 751157) -> (bool, str):
@@ -278,6 +365,26 @@ def _get_blockprice(block: int = 751157) -> str:
     return f"```\n{Bitcoin_blockprice[int(block)].as_str}\n```"
 
 
+def _get_exchanges(block: int = 751157) -> str:
+    logger.debug("Entering _get_exchanges")
+    global Bitcoin_blockprice, Bitcoin_exchangeprice
+    if not _check_end(block)[0]:
+        return _check_end(block)[1]
+    if not Bitcoin_exchangeprice.get(int(block)):
+        return f"No exchange traded during block {block}."
+    return f"```\n{Bitcoin_exchangeprice.as_str(Bitcoin_blockprice[int(block)])}\n```"
+
+
+def _get_rollup(period: str = "difficulty", block: int = 751157) -> str:
+    logger.debug("Entering _get_rollup")
+    global Bitcoin_rollups
+    if not _check_end(block)[0]:
+        return _check_end(block)[1]
+    # a single row read, the rollups are materialized when the price data is built
+    rollup = Bitcoin_rollups[period][int(block) // ROLLUP_SPANS[period]]
+    return f"```\n{rollup.as_str}\n```"
+
+
 def _get_satsusd(block: int = 751157) -> float:
     logger.debug("Entering _get_satsusd")
     global Bitcoin_blockprice
@@ -344,6 +451,9 @@ def main() -> None:
     application.add_handler(CommandHandler("txprice", txprice))
     application.add_handler(CommandHandler("usd_block", usdatblock))
     application.add_handler(CommandHandler("btc_block", btcatblock))
+    application.add_handler(CommandHandler("compare", compare))
+    application.add_handler(CommandHandler("chart", chart))
+    application.add_handler(CommandHandler("epoch", epoch))
     #application.add_handler(CommandHandler("update", update))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("start", start))
@@ -0,0 +1,212 @@
+import asyncio, json, hashlib, bisect
+from itertools import accumulate
+from urllib.parse import urlsplit, parse_qs
+from rollups import ROLLUP_SPANS
+import logging
+
+logger = logging.getLogger(__name__)
+
+'''
+HTTP/JSON API over the in-memory block price store.
+
+    GET  /block/<height>                 one block
+    GET  /blocks?heights=1,2,3           a batch of blocks, also POST /blocks with a json list of heights
+    GET  /range?from=<height>&to=<height>  every block in a range, streamed
+    GET  /time/<unix timestamp>          the block whose time span contains the timestamp
+    GET  /rollup/<period>/<height>       the day, difficulty or halving rollup containing a block
+
+Connections are kept alive (HTTP/1.1) unless the client asks to close them.
+'''
+
+MAX_BATCH = 10000
+MAX_BODY = 1 << 20  # bytes, a full batch of heights is well under this
+STREAM_BATCH = 1000
+IDLE_TIMEOUT = 30
+IMMUTABLE = "public, max-age=31536000, immutable"
+SHORT_LIVED = "public, max-age=60"
+STATUS = {200: "OK", 304: "Not Modified", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+          413: "Payload Too Large"}
+
+
+class APIError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class PriceAPI:
+    ''' Serves the block prices and rollups the bot already holds in memory '''
+
+    def __init__(self, btc_blockprice: dict, btc_rollups: dict, version: str = None):
+        self.blockprice = btc_blockprice
+        self.rollups = btc_rollups
+        # every block we hold is at least 10 behind the tip when calc_blocks writes it, so
+        # they are final and only change if the whole data set is rebuilt
+        self.heights = sorted(btc_blockprice.keys())
+        # block timestamps aren't monotonic, so /time bisects a running max of the close times
+        # and scans forward while a later block could still open at or before the timestamp
+        closetimes = [btc_blockprice[height].closetime for height in self.heights]
+        self.max_closetimes = list(accumulate(closetimes, max))
+        opentimes = [btc_blockprice[height].opentime for height in self.heights]
+        self.min_opentimes = list(accumulate(reversed(opentimes), min))[::-1]
+        # the data_version of the block price file, it changes whenever a rebuild changes any column.
+        # Files from before the checksums have none, so their ranges can't be served as immutable.
+        self.version = version
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8080):
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        logger.info(f"Price API listening on {host}:{port}")
+        return server
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), IDLE_TIMEOUT)
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError):
+                    break
+                lines = head.decode("latin-1").split("\r\n")
+                try:
+                    method, target, version = lines[0].split(" ", 2)
+                except ValueError:
+                    await self._send(writer, 400, {"error": "Malformed request line"}, keep_alive=False)
+                    break
+                headers = {}
+                for line in lines[1:]:
+                    if ":" in line:
+                        name, value = line.split(":", 1)
+                        headers[name.strip().lower()] = value.strip()
+                body = b""
+                if "content-length" in headers:
+                    if not headers["content-length"].isdigit():
+                        await self._send(writer, 400, {"error": "Invalid Content-Length"}, keep_alive=False)
+                        break
+                    if int(headers["content-length"]) > MAX_BODY:
+                        await self._send(writer, 413, {"error": f"Body over {MAX_BODY} bytes"}, keep_alive=False)
+                        break
+                    body = await reader.readexactly(int(headers["content-length"]))
+                connection = headers.get("connection", "").lower()
+                keep_alive = connection != "close" and (version == "HTTP/1.1" or connection == "keep-alive")
+                await self.handle_request(writer, method, target, headers, body, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError) as e:
+            logger.debug(f"API connection error: {e}")
+        finally:
+            writer.close()
+
+    async def handle_request(self, writer, method: str, target: str, headers: dict, body: bytes, keep_alive: bool):
+        url = urlsplit(target)
+        path = [part for part in url.path.split("/") if part]
+        query = parse_qs(url.query)
+        try:
+            if method not in ("GET", "POST"):
+                raise APIError(405, f"Method {method} not allowed")
+            if path[:1] == ["range"] and method == "GET":
+                return await self._stream_range(writer, query, headers, keep_alive)
+            data, cache_control = self._route(method, path, query, body)
+        except APIError as e:
+            return await self._send(writer, e.status, {"error": e.message}, keep_alive=keep_alive)
+        except (ValueError, IndexError, KeyError, TypeError) as e:
+            return await self._send(writer, 400, {"error": str(e)}, keep_alive=keep_alive)
+        payload = json.dumps(data).encode("utf-8")
+        etag = f'"{hashlib.sha1(payload).hexdigest()}"'
+        if headers.get("if-none-match") == etag:
+            return await self._send(writer, 304, None, etag=etag, cache_control=cache_control, keep_alive=keep_alive)
+        await self._send(writer, 200, payload, etag=etag, cache_control=cache_control, keep_alive=keep_alive)
+
+    def _route(self, method: str, path: list, query: dict, body: bytes) -> (object, str):
+        if path[:1] == ["block"] and len(path) == 2:
+            return self._block(int(path[1])).as_dict, IMMUTABLE
+        if path == ["blocks"]:
+            if method == "POST":
+                heights = json.loads(body)
+                if not isinstance(heights, list):
+                    raise APIError(400, "POST /blocks takes a json list of heights")
+                heights = [int(height) for height in heights]
+            else:
+                heights = [int(height) for height in query.get("heights", [""])[0].split(",") if height]
+            if len(heights) > MAX_BATCH:
+                raise APIError(400, f"At most {MAX_BATCH} heights per batch")
+            data = {str(height): (self.blockprice[height].as_dict if height in self.blockprice else None)
+                    for height in heights}
+            # a height we don't have yet will have data after the next rebuild, so don't let it stick
+            return data, IMMUTABLE if all(height in self.blockprice for height in heights) else SHORT_LIVED
+        if path[:1] == ["time"] and len(path) == 2:
+            return self._block_at(float(path[1])).as_dict, SHORT_LIVED
+        if path[:1] == ["rollup"] and len(path) == 3:
+            period, height = path[1], int(path[2])
+            if period not in ROLLUP_SPANS:
+                raise APIError(404, f"Unknown rollup period {period}")
+            rollup = self.rollups.get(period, {}).get(height // ROLLUP_SPANS[period])
+            if rollup is None:
+                raise APIError(404, f"No {period} rollup for block {height}")
+            # the newest row keeps growing as blocks arrive, older rows are complete
+            complete = rollup.last_block == rollup.block_height + ROLLUP_SPANS[period] - 1
+            return rollup.as_dict, IMMUTABLE if complete else SHORT_LIVED
+        raise APIError(404, f"Unknown path /{'/'.join(path)}")
+
+    def _block(self, height: int):
+        if height not in self.blockprice:
+            raise APIError(404, f"No price data for block {height}")
+        return self.blockprice[height]
+
+    def _block_at(self, timestamp: float):
+        # every block before `index` closed before the timestamp, so the first match is at or after it
+        index = bisect.bisect_left(self.max_closetimes, timestamp)
+        while index < len(self.heights) and self.min_opentimes[index] <= timestamp:
+            price = self.blockprice[self.heights[index]]
+            if price.opentime <= timestamp <= price.closetime:
+                return price
+            index += 1
+        raise APIError(404, f"No block covers time {timestamp:.0f}")
+
+    async def _stream_range(self, writer, query: dict, headers: dict, keep_alive: bool):
+        start = int(query["from"][0])
+        end = int(query.get("to", [self.heights[-1]])[0])
+        # an open ended range, or one past our last block, grows when new blocks arrive
+        open_ended = "to" not in query or end > self.heights[-1]
+        cache_control = SHORT_LIVED if open_ended or self.version is None else IMMUTABLE
+        # range bodies are streamed so the etag comes from the range and data set, not the body
+        etag = f'"range-{start}-{end}-{self.version}"'
+        if headers.get("if-none-match") == etag:
+            return await self._send(writer, 304, None, etag=etag, cache_control=cache_control, keep_alive=keep_alive)
+        writer.write(self._head(200, {"Content-Type": "application/json",
+                                      "Transfer-Encoding": "chunked",
+                                      "ETag": etag,
+                                      "Cache-Control": cache_control}, keep_alive))
+        first = bisect.bisect_left(self.heights, start)
+        last = bisect.bisect_right(self.heights, end)
+        separator = "["
+        for batch_start in range(first, last, STREAM_BATCH):
+            rows = [json.dumps(self.blockprice[height].as_dict)
+                    for height in self.heights[batch_start:min(batch_start + STREAM_BATCH, last)]]
+            self._write_chunk(writer, (separator + ",".join(rows)).encode("utf-8"))
+            separator = ","
+            await writer.drain()
+        self._write_chunk(writer, b"[]" if separator == "[" else b"]")
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    @staticmethod
+    def _write_chunk(writer, data: bytes):
+        writer.write(f"{len(data):x}\r\n".encode("latin-1") + data + b"\r\n")
+
+    @staticmethod
+    def _head(status: int, headers: dict, keep_alive: bool) -> bytes:
+        headers["Connection"] = "keep-alive" if keep_alive else "close"
+        lines = [f"HTTP/1.1 {status} {STATUS[status]}"] + [f"{name}: {value}" for name, value in headers.items()]
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+    async def _send(self, writer, status: int, payload, etag: str = None, cache_control: str = "no-store",
+                    keep_alive: bool = True):
+        if isinstance(payload, dict):
+            payload = json.dumps(payload).encode("utf-8")
+        headers = {"Content-Type": "application/json",
+                   "Content-Length": str(len(payload or b"")),
+                   "Cache-Control": cache_control}
+        if etag:
+            headers["ETag"] = etag
+        writer.write(self._head(status, headers, keep_alive) + (payload or b""))
+        await writer.drain()
@@ -0,0 +1,160 @@
+import io, logging, threading, pickle, bz2, os, bisect
+from array import array
+from collections import OrderedDict
+from itertools import groupby
+# use Figure directly rather than pyplot, it keeps no global figure state so charts can render off the event loop
+from matplotlib.figure import Figure
+
+logger = logging.getLogger(__name__)
+
+# columns of every bucket, block_height is the first block in it
+BUCKET_COLUMNS = ('block_height', 'open', 'high', 'low', 'close', 'volume')
+
+
+def _merge_buckets(rows, first_height: int, size: int):
+    # merge (block_height, open, high, low, close, volume) rows, in height order,
+    # into one row per `size` blocks counted from first_height
+    for _, group in groupby(rows, key=lambda row: (row[0] - first_height) // size):
+        group = list(group)
+        lows = [row[3] for row in group if row[3] > 0.0]
+        yield (group[0][0], group[0][1], max(row[2] for row in group), min(lows) if lows else 0.0,
+               group[-1][4], sum(row[5] for row in group))
+
+
+class PricePyramid:
+    ''' Multi-resolution open/high/low/close/volume buckets over the block prices '''
+
+    def __init__(self, btc_blockprice: dict, factor: int = 2, levels: list = None):
+        self.blockprice = btc_blockprice
+        self.factor = factor
+        self.first_height = min(btc_blockprice.keys())
+        self.last_height = max(btc_blockprice.keys())
+        # level 0 is the block prices themselves, every level above holds packed columns of the
+        # buckets that have a price: {'block_height': array('q'), 'open': array('d'), ...}
+        self.levels = levels if levels is not None else self._build()
+        logger.debug(f"Price pyramid has {len(self.levels)} levels.")
+
+    def _build(self) -> list:
+        levels = [None]
+        rows = ((height, price.open, price.high, price.low, price.close, price.volume)
+                for height, price in sorted(self.blockprice.items()))
+        # each level above merges `factor` neighbouring buckets of the level below
+        while len(levels) == 1 or len(levels[-1]['block_height']) > 1:
+            level = {'block_height': array('q')}
+            level.update({column: array('d') for column in BUCKET_COLUMNS[1:]})
+            for row in _merge_buckets(rows, self.first_height, self.factor ** len(levels)):
+                for column, value in zip(level.values(), row):
+                    column.append(value)
+            levels.append(level)
+            rows = zip(*level.values())
+        return levels
+
+    def level_for(self, start: int, end: int, width: int) -> int:
+        # the finest level that needs no more than `width` buckets for the range
+        span = end - start + 1
+        level = 0
+        while level < len(self.levels) - 1 and span > width * self.factor ** level:
+            level += 1
+        return level
+
+    def query(self, start: int, end: int, width: int) -> (int, dict):
+        # read only the buckets of the chosen level that cover the block range, as {column: values}
+        start = max(start, self.first_height)
+        end = min(end, self.last_height)
+        if start > end:
+            raise ValueError(f"No price data between block {start} and {end}.")
+        level = self.level_for(start, end, width)
+        if level == 0:
+            prices = [self.blockprice[height] for height in range(start, end + 1) if height in self.blockprice]
+            return level, {column: [getattr(price, column) for price in prices] for column in BUCKET_COLUMNS}
+        size = self.factor ** level
+        buckets = self.levels[level]
+        # a bucket's block_height is its first priced block, so find it from the bucket's start
+        first = bisect.bisect_left(buckets['block_height'], start - (start - self.first_height) % size)
+        last = bisect.bisect_right(buckets['block_height'], end)
+        return level, {column: buckets[column][first:last] for column in BUCKET_COLUMNS}
+
+
+def save_pyramid(pyramid: PricePyramid, version: str, filename: str = "btc_pricepyramid.pkl.bz2"):
+    # the levels are derived from the block prices, so they are stored with that data's version
+    with bz2.BZ2File(f"{filename}.tmp", "wb") as f:
+        pickle.dump({'version': version, 'factor': pyramid.factor, 'levels': pyramid.levels}, f)
+    os.replace(f"{filename}.tmp", filename)
+
+
+def load_pyramid(btc_blockprice: dict, version: str, filename: str = "btc_pricepyramid.pkl.bz2") -> PricePyramid:
+    # Returns None if there is no saved pyramid or it was built from other block price data
+    if version is None or not os.path.exists(filename):
+        return None
+    with bz2.BZ2File(filename, "rb") as f:
+        temp_pyramid = pickle.load(f)
+    if temp_pyramid['version'] != version:
+        return None
+    return PricePyramid(btc_blockprice, temp_pyramid['factor'], temp_pyramid['levels'])
+
+
+class PriceChart:
+    ''' Renders png charts from a PricePyramid, caching them by range and resolution '''
+
+    def __init__(self, pyramid: PricePyramid, width: int = 800, height: int = 450, cache_size: int = 256):
+        self.pyramid = pyramid
+        self.width = width
+        self.height = height
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        # renders run in worker threads, so every cache read and write happens under the lock
+        self.cache_lock = threading.Lock()
+        # matplotlib itself isn't thread safe (e.g. its mathtext parser), so one render at a time
+        self.render_lock = threading.Lock()
+
+    def _cached(self, key: tuple) -> bytes:
+        with self.cache_lock:
+            png = self.cache.get(key)
+            if png is not None:
+                self.cache.move_to_end(key)
+            return png
+
+    def render(self, start: int, end: int) -> bytes:
+        start = max(start, self.pyramid.first_height)
+        end = min(end, self.pyramid.last_height)
+        key = (start, end, self.pyramid.level_for(start, end, self.width))
+        png = self._cached(key)
+        if png is not None:
+            return png
+        level, buckets = self.pyramid.query(start, end, self.width)
+        if not buckets['block_height']:
+            raise ValueError(f"No price data between block {start} and {end}.")
+        with self.render_lock:
+            # another request may have rendered the same chart while we waited
+            png = self._cached(key)
+            if png is not None:
+                return png
+            png = self._plot(start, end, buckets)
+        with self.cache_lock:
+            self.cache[key] = png
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return png
+
+    def _plot(self, start: int, end: int, buckets: dict) -> bytes:
+        heights = buckets['block_height']
+        logger.debug(f"Rendering chart for blocks {start} to {end} from {len(heights)} buckets.")
+        dpi = 100
+        fig = Figure(figsize=(self.width / dpi, self.height / dpi), dpi=dpi)
+        ax_price, ax_volume = fig.subplots(2, 1, sharex=True, gridspec_kw={'height_ratios': [3, 1]})
+        ax_price.fill_between(heights, buckets['low'], buckets['high'], step="post", alpha=0.3, linewidth=0)
+        ax_price.step(heights, buckets['close'], where="post", linewidth=1)
+        lows = [low for low in buckets['low'] if low > 0.0]
+        if lows and max(buckets['high']) / min(lows) > 100:
+            ax_price.set_yscale("log")
+        ax_price.set_ylabel("$/BTC")
+        ax_price.set_title(f"BTC Block Price, blocks {start} to {end}")
+        ax_volume.bar(heights, buckets['volume'],
+                      width=max(1, heights[-1] - heights[0]) / len(heights), align="edge")
+        ax_volume.set_ylabel("BTC")
+        ax_volume.set_xlabel("Block")
+        fig.tight_layout()
+        output = io.BytesIO()
+        fig.savefig(output, format="png")
+        return output.getvalue()
@@ -1,6 +1,10 @@
 import pickle, bz2, time, os, asyncio
 from indexed_bzip2 import IndexedBzip2File
-from Block_Classes import Tick, BTCBlock, BTCPrice
+from Block_Classes import Tick, BTCBlock, BTCPrice, ExchangePrices
+from rollups import build_rollups, save_rollups
+from price_chart import PricePyramid, save_pyramid
+from tick_archive import TickArchive, archive_csv
+from price_validation import validate_blockprices, pack_blockprices, data_version
 import logging
 import httpx
 import subprocess
@@ -33,6 +37,31 @@ async def download_price_data():
 def recompress():
     subprocess.run('ls *.gz | parallel "gunzip -c {} | pbzip2 -c > {.}.bz2"', shell=True)
 
+
+def archive_price_data():
+    # convert each csv.bz2 into its columnar tick archive, after the first run this only appends new ticks
+    for file in ['mtgoxUSD.csv.bz2', 'bitstampUSD.csv.bz2', 'coinbaseUSD.csv.bz2', 'krakenUSD.csv.bz2']:
+        if os.path.exists(file):
+            archive_csv(file)
+
+
+def iter_ticks(file: str, start: float = 0.0):
+    # read ticks from the exchange's tick archive if we have one, otherwise parse the csv.bz2
+    exchange = file.split('.')[0]
+    if os.path.exists(f"{exchange}.ticks"):
+        yield from TickArchive(f"{exchange}.ticks").iter_ticks(start=start, exchange=exchange)
+        return
+    with IndexedBzip2File(file, parallelization=os.cpu_count()) as f:
+        for line in f:
+            line_array = line.decode('utf-8').strip().split(',')  # needed for gzipped files
+            temp_tick = Tick(timestamp=float(line_array[0]),
+                             price=float(line_array[1]),
+                             volume=float(line_array[2]),
+                             exchange=exchange)
+            if temp_tick.timestamp < start: continue
+            yield temp_tick
+
+
 # print a list of BTCPrice objects to csv
 def print_price_data_to_csv(data, filename):
     with open(filename, 'w') as f:
@@ -44,53 +73,67 @@ def print_price_data_to_csv(data, filename):
 def calc_blocks(return_data: bool = False):
     btc_timestamps = BTCBlock.parse_csv("timestamps.txt")
     bzfiles = ['mtgoxUSD.csv.bz2', 'bitstampUSD.csv.bz2', 'coinbaseUSD.csv.bz2', 'krakenUSD.csv.bz2']
+    # filled in by consolidate as each block is closed, in the same pass as the composite price
+    exchange_prices = ExchangePrices()
     for file in bzfiles:
         btc_iterator = iter(btc_timestamps)
         current_block = next(btc_iterator)
         exhausted = False
         final_blockheight = 0
         print(f"Processing {file}")
-        with IndexedBzip2File(file, parallelization=os.cpu_count()) as f:
-            for line in enumerate(f):
-                if exhausted: continue
-                line_array = line[1].decode('utf-8').strip().split(',')  # needed for gzipped files
-                temp_tick = Tick(timestamp=float(line_array[0]),
-                                 price=float(line_array[1]),
-                                 volume=float(line_array[2]),
-                                 exchange=file[0:-4])
-                if temp_tick.timestamp < 1270000000: continue  # ignore spurious data before 2010
-                if current_block.in_range(temp_tick):
-                    continue
-                else:
-                    while not current_block.in_range(temp_tick):
-                        current_block.consolidate()
-                        last_close = current_block.close
-                        try:
-                            final_blockheight = current_block.block_height
-                            current_block = next(btc_iterator)
-                        except StopIteration:
-                            exhausted = True
-                            break
-                        if not current_block.seen:
-                            current_block.open = last_close
-                            current_block.close = last_close
-                            current_block.high = last_close
-                            current_block.low = last_close
-                            current_block.seen = True
+        # ignore spurious data before 2010
+        for temp_tick in iter_ticks(file, start=1270000000):
+            if exhausted: break
+            if current_block.in_range(temp_tick):
+                continue
+            else:
+                while not current_block.in_range(temp_tick):
+                    current_block.consolidate(exchange_prices)
+                    last_close = current_block.close
+                    try:
+                        final_blockheight = current_block.block_height
+                        current_block = next(btc_iterator)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    if not current_block.seen:
+                        current_block.open = last_close
+                        current_block.close = last_close
+                        current_block.high = last_close
+                        current_block.low = last_close
+                        current_block.vwap = last_close
+                        current_block.seen = True
 
     # step back 10 blocks to ensure when we add more later there isn't a time-frame discrepancy
     print_price_data_to_csv(btc_timestamps[0:final_blockheight - 10], "test.csv")
 
-    # ensure that no blocks open price disagrees with prior block close price
-    #for i in range(1, len(btc_timestamps)):
-    #    if btc_timestamps[i].open != btc_timestamps[i - 1].close:
-    #        btc_timestamps[i].open = btc_timestamps[i - 1].close
-
     temp_btc_blockprice = {}
     for id, block in enumerate(btc_timestamps[0:final_blockheight - 10]):
-        if (block.block_height > 700000 and block.open == 0.0): continue
         temp_btc_blockprice[block.block_height] = block.as_dict
-    pickle.dump(temp_btc_blockprice, bz2.BZ2File("btc_blockprice.pkl.bz2", "wb"))
+
+    # fill holes, report open/close gaps and stamp the output so the bot can verify it
+    report = validate_blockprices(temp_btc_blockprice,
+                                  {block.block_height: (block.opentime, block.closetime) for block in btc_timestamps})
+    print(report.as_str)
+    with open("validation_report.json", "w") as f:
+        f.write(report.json)
+    # the checksums travel inside the payload, and the file is swapped in whole so a crash can't
+    # leave the bot with half a file
+    payload = pack_blockprices(temp_btc_blockprice)
+    with bz2.BZ2File("btc_blockprice.pkl.bz2.tmp", "wb") as f:
+        pickle.dump(payload, f)
+    os.replace("btc_blockprice.pkl.bz2.tmp", "btc_blockprice.pkl.bz2")
+
+    # per exchange prices go in their own file as packed columns, one array per exchange per field
+    exchange_prices.truncate(max(temp_btc_blockprice.keys()))
+    with bz2.BZ2File("btc_exchangeprice.pkl.bz2", "wb") as f:
+        pickle.dump(exchange_prices.as_dict, f)
+
+    # every block price was just rebuilt, so rebuild the day / difficulty / halving rollups and the
+    # chart pyramid with them
+    btc_blockprice = {height: BTCPrice.from_dict(price) for height, price in temp_btc_blockprice.items()}
+    save_rollups(build_rollups(btc_blockprice), data_version(payload['checksums']))
+    save_pyramid(PricePyramid(btc_blockprice), data_version(payload['checksums']))
 
     if return_data:
         return temp_btc_blockprice
@@ -158,6 +201,7 @@ if __name__ == '__main__':
     asyncio.get_event_loop().run_until_complete(load_new_timestamps())
     asyncio.get_event_loop().run_until_complete(download_price_data())
     recompress()
+    archive_price_data()
     calc_blocks(True)
 
     print(f"Time elapsed: {time.time() - start}")
@@ -0,0 +1,171 @@
+import hashlib, json, math
+from array import array
+from dataclasses import dataclass, asdict, field
+from Block_Classes import BTCPrice
+import logging
+
+logger = logging.getLogger(__name__)
+
+OHLC_COLUMNS = ('open', 'high', 'low', 'close')
+PRICE_COLUMNS = OHLC_COLUMNS + ('vwap',)
+NUMERIC_COLUMNS = ('opentime', 'closetime', 'open', 'high', 'low', 'close', 'volume', 'vwap')
+
+
+# Dataclass to hold the outcome of a validation pass
+@dataclass
+class ValidationReport:
+    ''' Class to hold the problems found (and fixed) in a block price data set'''
+    first_height: int = 0
+    last_height: int = 0
+    missing_heights: list = field(default_factory=list)
+    bad_prices: list = field(default_factory=list)
+    non_monotonic: list = field(default_factory=list)
+    discontinuities: list = field(default_factory=list)
+    untimed: list = field(default_factory=list)
+    filled: int = 0
+    repaired: int = 0
+
+    @property
+    def as_str(self):
+        """
+        get a short summary for the logs
+        """
+        return (f"Validated blocks {self.first_height} to {self.last_height}: "
+                f"{len(self.missing_heights)} missing, "
+                f"{len(self.bad_prices)} zero/NaN priced, "
+                f"{self.filled} forward filled, "
+                f"{self.repaired} with single fields repaired, "
+                f"{len(self.untimed)} without block times, "
+                f"{len(self.discontinuities)} opening away from their parent's close, "
+                f"{len(self.non_monotonic)} blocks timestamped before their parent")
+
+    @property
+    def json(self):
+        """
+        get the json formated string
+        """
+        return json.dumps(asdict(self))
+
+
+def _columns(btc_blockprice: dict, heights: range) -> dict:
+    # pivot the {height: row} data into one list per column, None where a height is missing
+    rows = [btc_blockprice.get(height) for height in heights]
+    return {column: [row.get(column) if row else None for row in rows] for column in NUMERIC_COLUMNS}
+
+
+def validate_blockprices(btc_blockprice: dict, blocktimes: dict = None, reconcile: bool = False) -> ValidationReport:
+    # Check the whole data set column by column, forward fill holes in place and report what was found.
+    # blocktimes maps height -> (opentime, closetime) and supplies the times of missing blocks.
+    # A block's open is its first trade, so it rarely equals the parent's close. Those gaps are only
+    # reported unless reconcile is set.
+    blocktimes = {} if blocktimes is None else blocktimes
+    first, last = min(btc_blockprice.keys()), max(btc_blockprice.keys())
+    heights = range(first, last + 1)
+    report = ValidationReport(first_height=first, last_height=last)
+    columns = _columns(btc_blockprice, heights)
+    close = columns['close']
+
+    report.missing_heights = [height for height, value in zip(heights, close) if value is None]
+    # blocks before the first trade legitimately have no price, after it a zero or NaN is a hole
+    valid = {column: [value is not None and value != 0.0 and not math.isnan(value) for value in columns[column]]
+             for column in PRICE_COLUMNS}
+    priced = next((i for i, ok in enumerate(zip(*(valid[column] for column in OHLC_COLUMNS))) if all(ok)),
+                  len(close))
+    bad = [i for i in range(priced, len(close))
+           if close[i] is not None and not all(valid[column][i] for column in OHLC_COLUMNS)]
+    report.bad_prices = [heights[i] for i in bad]
+
+    # missing blocks and blocks without a usable close are forward filled from the parent's close,
+    # otherwise only the invalid fields are repaired and the block's real prices are kept
+    for i in sorted(set(bad) | {height - first for height in report.missing_heights}):
+        if i == 0:
+            continue
+        previous = btc_blockprice[heights[i - 1]]
+        row = btc_blockprice.get(heights[i])
+        if row is None:
+            if heights[i] not in blocktimes:
+                report.untimed.append(heights[i])
+            opentime, closetime = blocktimes.get(heights[i], (0.0, 0.0))
+            row = {'block_height': heights[i], 'opentime': opentime, 'closetime': closetime}
+            btc_blockprice[heights[i]] = row
+        if not valid['close'][i]:
+            fill = previous['close'] if i >= priced else 0.0
+            for column in PRICE_COLUMNS:
+                row[column] = fill
+            row['volume'] = 0.0
+            report.filled += 1
+            continue
+        if not valid['open'][i]:
+            row['open'] = previous['close']
+        if not valid['high'][i]:
+            row['high'] = max(row['open'], row['close'])
+        if not valid['low'][i]:
+            row['low'] = min(row['open'], row['close'])
+        report.repaired += 1
+    # a block with prices but no usable vwap (e.g. zero volume) takes its close
+    for i in range(priced, len(close)):
+        if not valid['vwap'][i] and valid['close'][i]:
+            btc_blockprice[heights[i]]['vwap'] = close[i]
+    columns = _columns(btc_blockprice, heights)
+    close = columns['close']
+
+    closetime = columns['closetime']
+    report.non_monotonic = [heights[i] for i in range(1, len(closetime)) if closetime[i] < closetime[i - 1]]
+    # the first priced block has no priced parent to continue from
+    report.discontinuities = [heights[i] for i in range(priced + 1, len(close))
+                              if columns['open'][i] != close[i - 1]]
+    if reconcile:
+        # move the open to where the parent closed, widen the range if that puts the open outside it
+        for height in report.discontinuities:
+            row, previous = btc_blockprice[height], btc_blockprice[height - 1]
+            row['open'] = previous['close']
+            row['high'] = max(row['high'], row['open'])
+            row['low'] = min(row['low'], row['open'])
+    return report
+
+
+def pack_columns(btc_blockprice: dict) -> dict:
+    # one fixed width array per column, in block height order
+    heights = sorted(btc_blockprice.keys())
+    rows = [btc_blockprice[height] for height in heights]
+    columns = {'block_height': array('q', heights)}
+    for column in NUMERIC_COLUMNS:
+        columns[column] = array('d', [row.get(column, 0.0) for row in rows])
+    return columns
+
+
+def column_checksums(columns: dict) -> dict:
+    # sha256 of every packed column buffer
+    return {column: hashlib.sha256(values.tobytes()).hexdigest() for column, values in columns.items()}
+
+
+def pack_blockprices(btc_blockprice: dict) -> dict:
+    """
+    get the payload calc_blocks pickles, the packed columns stamped with their checksums
+    """
+    columns = pack_columns(btc_blockprice)
+    return {'columns': columns, 'checksums': column_checksums(columns)}
+
+
+def data_version(checksums: dict) -> str:
+    """
+    get a single id for a data set, derived data (e.g. the rollups) records it to notice rebuilds
+    """
+    return hashlib.sha256(json.dumps(checksums, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def unpack_blockprices(payload: dict) -> dict:
+    # Verify a pickled payload against its own checksums and rebuild the {height: BTCPrice} store.
+    # Raises ValueError if any column does not match.
+    if 'columns' not in payload:
+        logger.warning("Block price data has no checksums (old format), unable to verify it.")
+        return {int(block): BTCPrice.from_dict(price) for block, price in payload.items()}
+    columns = payload['columns']
+    actual = column_checksums(columns)
+    mismatched = [column for column in payload['checksums'] if payload['checksums'][column] != actual.get(column)]
+    if mismatched:
+        raise ValueError(f"Checksum mismatch in block price data for columns: {', '.join(mismatched)}")
+    return {height: BTCPrice(opentime=opentime, closetime=closetime, open=open, high=high, low=low,
+                             close=close, volume=volume, block_height=height, vwap=vwap)
+            for height, opentime, closetime, open, high, low, close, volume, vwap
+            in zip(columns['block_height'], *(columns[column] for column in NUMERIC_COLUMNS))}
@@ -0,0 +1,99 @@
+import pickle, bz2, os
+from itertools import groupby
+from dataclasses import dataclass
+from datetime import datetime
+from Block_Classes import BTCPrice
+import logging
+
+logger = logging.getLogger(__name__)
+
+# number of blocks in each rollup period
+ROLLUP_SPANS = {'day': 144, 'difficulty': 2016, 'halving': 210000}
+
+
+# Dataclass to hold the BTC Price over a fixed span of blocks
+@dataclass
+class BTCRollup(BTCPrice):
+    ''' Class to hold BTC Price Information for a day, difficulty or halving epoch'''
+    period: str = ""
+    index: int = 0
+    last_block: int = 0
+
+    @property
+    def as_dict(self):
+        """
+        get a python dictionary
+        """
+        return {'block_height':int(self.block_height),
+                'opentime':int(self.opentime),
+                'closetime':int(self.closetime),
+                'open':self.open,
+                'high':self.high,
+                'low':self.low,
+                'close':self.close,
+                'volume':self.volume,
+                'vwap':self.vwap,
+                'period':self.period,
+                'index':self.index,
+                'last_block':self.last_block}
+
+    @property
+    def as_str(self):
+        """
+        get a nicely formated string for sending to telegram
+        """
+        return (f"BTC Price for {self.period} {self.index} "
+                f"(blocks {self.block_height} to {self.last_block}):\n"
+                f"From {datetime.fromtimestamp(self.opentime)}\n"
+                f"To   {datetime.fromtimestamp(self.closetime)}\n"
+                f"Open:   {self.open:,.2f} $/₿\n"
+                f"High:   {self.high:,.2f} $/₿\n"
+                f"Low:    {self.low:,.2f} $/₿\n"
+                f"Close:  {self.close:,.2f} $/₿\n"
+                f"VWAP:   {self.vwap:,.2f} $/₿\n"
+                f"Volume: {self.volume:,.8f} ₿\n")
+
+    @classmethod
+    def from_prices(cls, period: str, index: int, prices: list):
+        merged = BTCPrice.merge(prices)
+        return cls(opentime=merged.opentime,
+                   closetime=merged.closetime,
+                   open=merged.open,
+                   high=merged.high,
+                   low=merged.low,
+                   close=merged.close,
+                   volume=merged.volume,
+                   block_height=index * ROLLUP_SPANS[period],
+                   vwap=merged.vwap,
+                   period=period,
+                   index=index,
+                   last_block=prices[-1].block_height)
+
+
+def build_rollups(btc_blockprice: dict) -> dict:
+    # One table per period, each row merges the blocks of one day, difficulty or halving epoch.
+    # The rollups are rebuilt whenever the block prices are, so every row agrees with /block.
+    heights = sorted(btc_blockprice.keys())
+    return {period: {index: BTCRollup.from_prices(period, index, [btc_blockprice[height] for height in group])
+                     for index, group in groupby(heights, key=lambda height: height // span)}
+            for period, span in ROLLUP_SPANS.items()}
+
+
+def load_rollups(filename: str = "btc_rollups.pkl.bz2") -> (dict, str):
+    # Returns the rollup tables and the version of the block price data they were built from
+    if not os.path.exists(filename):
+        return {}, None
+    with bz2.BZ2File(filename, "rb") as f:
+        temp_rollups = pickle.load(f)
+    if 'tables' not in temp_rollups:
+        return {}, None  # written before rollups were versioned, treat as stale
+    return ({period: {int(index): BTCRollup.from_dict(row) for index, row in table.items()}
+             for period, table in temp_rollups['tables'].items()},
+            temp_rollups['version'])
+
+
+def save_rollups(rollups: dict, version: str, filename: str = "btc_rollups.pkl.bz2"):
+    temp_rollups = {period: {index: row.as_dict for index, row in table.items()}
+                    for period, table in rollups.items()}
+    with bz2.BZ2File(filename, "wb") as f:
+        pickle.dump({'version': version, 'tables': temp_rollups}, f)
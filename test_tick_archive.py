@@ -0,0 +1,24 @@
+from tick_archive import TickArchive
+
+
+def test_append_twice(tmp_path):
+    filename = str(tmp_path / "x.ticks")
+    archive = TickArchive(filename)
+    archive.append([(1000, 10.0, 1.0), (1001, 11.0, 2.0), (1003, 12.0, 3.0)])
+    archive.append([(1004, 13.0, 4.0), (1005, 14.0, 5.0)])
+    expected = [(1000, 10.0, 1.0), (1001, 11.0, 2.0), (1003, 12.0, 3.0), (1004, 13.0, 4.0), (1005, 14.0, 5.0)]
+    for reader in (archive, TickArchive(filename)):
+        assert len(reader) == 5
+        assert [chunk[0] for chunk in reader.chunks] == [0, reader.chunks[1][0]] and reader.chunks[1][0] > 0
+        assert [(tick.timestamp, tick.price, tick.volume) for tick in reader.iter_ticks()] == expected
+
+
+def test_truncated_append_is_dropped(tmp_path):
+    filename = str(tmp_path / "x.ticks")
+    TickArchive(filename).append([(1000, 10.0, 1.0), (1001, 11.0, 2.0)])
+    with open(filename, "ab") as f:
+        f.write(b"TCK1partial")
+    archive = TickArchive(filename)
+    assert len(archive) == 2
+    archive.append([(1002, 12.0, 3.0)])
+    assert [tick.timestamp for tick in TickArchive(filename).iter_ticks()] == [1000, 1001, 1002]
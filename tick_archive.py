@@ -0,0 +1,161 @@
+import os, mmap, struct
+from array import array
+from collections import Counter
+from itertools import accumulate
+from indexed_bzip2 import IndexedBzip2File
+from Block_Classes import Tick
+import logging
+
+logger = logging.getLogger(__name__)
+
+'''
+Chunked columnar tick archive, one file per exchange (e.g. krakenUSD.ticks).
+
+Each chunk is a fixed size header followed by three columns:
+    header   magic, tick count, min timestamp, max timestamp, first timestamp
+    deltas   int32 seconds since the previous tick (0 for the first), padded to 8 bytes
+    prices   float64
+    volumes  float64
+Columns are written in native byte order. Timestamps are whole seconds, as in the
+bitcoincharts csv files. The header min/max lets readers skip chunks by time range
+without touching their columns.
+'''
+
+CHUNK_MAGIC = b"TCK1"
+CHUNK_HEADER = struct.Struct("<4sIqqq")
+CHUNK_TICKS = 1 << 16
+
+
+def _chunk_size(count: int) -> int:
+    # header + padded deltas + prices + volumes
+    return CHUNK_HEADER.size + (count * 4 + 7) // 8 * 8 + count * 16
+
+
+class TickArchive:
+    ''' Class to read and append to a chunked columnar tick archive '''
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.chunks = []  # (offset, count, min_ts, max_ts, first_ts) for every chunk
+        self.size = 0  # end of the last complete chunk, anything after it is an interrupted append
+        if os.path.exists(filename):
+            self._read_index()
+
+    def _read_index(self):
+        file_size = os.path.getsize(self.filename)
+        with open(self.filename, "rb") as f:
+            offset = 0
+            while header := f.read(CHUNK_HEADER.size):
+                if len(header) < CHUNK_HEADER.size:
+                    logger.warning(f"Ignoring truncated chunk at {offset} in {self.filename}")
+                    break
+                magic, count, min_ts, max_ts, first_ts = CHUNK_HEADER.unpack(header)
+                if magic != CHUNK_MAGIC:
+                    raise ValueError(f"{self.filename} is not a tick archive (bad chunk at {offset})")
+                if offset + _chunk_size(count) > file_size:
+                    logger.warning(f"Ignoring truncated chunk at {offset} in {self.filename}")
+                    break
+                self.chunks.append((offset, count, min_ts, max_ts, first_ts))
+                offset += _chunk_size(count)
+                f.seek(offset)
+        self.size = offset
+
+    @property
+    def max_timestamp(self) -> int:
+        return max((chunk[3] for chunk in self.chunks), default=0)
+
+    def __len__(self):
+        return sum(chunk[1] for chunk in self.chunks)
+
+    def append(self, ticks) -> int:
+        # Append (timestamp, price, volume) rows as new chunks, returns the number of ticks written
+        written = 0
+        timestamps, prices, volumes = array('q'), array('d'), array('d')
+        # drop the partial tail of an interrupted append so new chunks start on a chunk boundary
+        if os.path.exists(self.filename) and os.path.getsize(self.filename) > self.size:
+            logger.warning(f"Truncating {self.filename} to its last complete chunk at {self.size}")
+            os.truncate(self.filename, self.size)
+        with open(self.filename, "ab") as f:
+            for timestamp, price, volume in ticks:
+                timestamps.append(int(timestamp))
+                prices.append(price)
+                volumes.append(volume)
+                if len(timestamps) == CHUNK_TICKS:
+                    written += self._write_chunk(f, timestamps, prices, volumes)
+                    timestamps, prices, volumes = array('q'), array('d'), array('d')
+            if timestamps:
+                written += self._write_chunk(f, timestamps, prices, volumes)
+        return written
+
+    def _write_chunk(self, f, timestamps: array, prices: array, volumes: array) -> int:
+        count = len(timestamps)
+        deltas = array('i', [0])
+        deltas.extend(timestamps[i] - timestamps[i - 1] for i in range(1, count))
+        offset = f.tell()
+        header = (CHUNK_MAGIC, count, min(timestamps), max(timestamps), timestamps[0])
+        f.write(CHUNK_HEADER.pack(*header))
+        deltas.tofile(f)
+        if count % 2:
+            f.write(b"\0" * 4)
+        prices.tofile(f)
+        volumes.tofile(f)
+        self.chunks.append((offset, *header[1:]))
+        # the chunk is complete, later appends on this object must not truncate it away
+        self.size = f.tell()
+        return count
+
+    def ticks_at(self, timestamp: int) -> Counter:
+        # count of every (timestamp, price, volume) row already archived in one second
+        return Counter((int(tick.timestamp), tick.price, tick.volume)
+                       for tick in self.iter_ticks(start=timestamp, end=timestamp))
+
+    def iter_ticks(self, start: float = 0.0, end: float = float("inf"), exchange: str = ""):
+        # Yield Tick objects between start and end, skipping chunks entirely outside the range
+        chunks = [chunk for chunk in self.chunks if chunk[3] >= start and chunk[2] <= end]
+        if not chunks:
+            return
+        with open(self.filename, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for offset, count, min_ts, max_ts, first_ts in chunks:
+                deltas_at = offset + CHUNK_HEADER.size
+                prices_at = deltas_at + (count * 4 + 7) // 8 * 8
+                volumes_at = prices_at + count * 8
+                # copy the columns out so no view into the map outlives the with block
+                with memoryview(mm) as view:
+                    deltas = view[deltas_at:deltas_at + count * 4].cast('i').tolist()
+                    prices = view[prices_at:volumes_at].cast('d').tolist()
+                    volumes = view[volumes_at:volumes_at + count * 8].cast('d').tolist()
+                for delta_sum, price, volume in zip(accumulate(deltas), prices, volumes):
+                    timestamp = first_ts + delta_sum
+                    if start <= timestamp <= end:
+                        yield Tick(timestamp=float(timestamp), price=price, volume=volume, exchange=exchange)
+
+
+def _read_csv(filename: str, after: int = 0, archived: Counter = None):
+    # Parse timestamp,price,volume rows from a bz2 csv, keeping only those from the `after` second on.
+    # Rows in that boundary second are dropped only if the same row is already in `archived`.
+    archived = Counter() if archived is None else archived
+    with IndexedBzip2File(filename, parallelization=os.cpu_count()) as f:
+        for line in f:
+            line_array = line.decode('utf-8').strip().split(',')
+            if len(line_array) < 3: continue
+            timestamp = int(float(line_array[0]))
+            if timestamp < after: continue
+            row = (timestamp, float(line_array[1]), float(line_array[2]))
+            if timestamp == after and archived[row] > 0:
+                archived[row] -= 1
+                continue
+            yield row
+
+
+def archive_csv(filename: str, archive_name: str = None) -> int:
+    # One time conversion of a csv.bz2 into a tick archive, or on later calls append only
+    # the ticks newer than what the archive already holds. Trades in the archive's last second
+    # may have been only partly downloaded last time, so that second is deduplicated row by row.
+    if archive_name is None:
+        archive_name = f"{filename.split('.')[0]}.ticks"
+    archive = TickArchive(archive_name)
+    after = archive.max_timestamp
+    archived = archive.ticks_at(after) if archive.chunks else Counter()
+    written = archive.append(_read_csv(filename, after, archived))
+    logger.info(f"Archived {written} ticks from {filename} into {archive_name}")
+    return written